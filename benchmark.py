@@ -0,0 +1,136 @@
+import argparse
+import json
+import librosa
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+from preprocess import FRAMES, SHIFTMS, load_wavs, rebuild_features, wav_to_mcep_file
+from utility import F0_METHODS, FEATURES, FEATURE_DTYPES, GenerateStatistics, StageTimer, load_features, speakers
+
+# 离线测试预处理速度：python benchmark.py --seconds 10 --files 4 --f0_methods harvest dio
+
+def synthesize(seconds: float, sr: int, seed: int):
+    """
+        Deterministic test signal: alternating voiced (harmonics of a gliding f0)
+        and unvoiced (white noise) parts of 100-400 ms, with short pauses between them.
+    """
+
+    rng = np.random.RandomState(seed)
+    n = int(seconds * sr)
+    wav = np.zeros(n)
+    pos = 0
+    while pos < n:
+        length = min(int(rng.uniform(0.1, 0.4) * sr), n - pos)
+        if rng.rand() < 0.7:
+            f0 = np.linspace(rng.uniform(90, 250), rng.uniform(90, 250), length)
+            phase = 2 * np.pi * np.cumsum(f0) / sr
+            part = sum(np.sin(k * phase) / k for k in range(1, 11))
+            part *= np.hanning(length) * 0.3
+        else:
+            part = rng.randn(length) * 0.05
+        wav[pos: pos + length] = part
+        pos += length + int(rng.uniform(0.02, 0.08) * sr)
+
+    return wav
+
+def make_corpus(folder: str, sr: int, files: int, seconds: float):
+    """
+        Write `files` synthetic wavs per speaker into `folder/{speaker}/`.
+    """
+
+    for spk_idx, one_speaker in enumerate(speakers):
+        os.makedirs(os.path.join(folder, one_speaker), exist_ok=True)
+        for i in range(files):
+            wav = synthesize(seconds, sr, seed=spk_idx * 1000 + i)
+            librosa.output.write_wav(os.path.join(folder, one_speaker, f'{i:03d}.wav'), wav.astype(np.float32), sr)
+
+def report(name: str, seconds: float, files: int, audio_seconds: float, **extra):
+    res = {
+        'name': name,
+        'seconds': seconds,
+        'files_per_second': files / seconds if seconds > 0 else None,
+        'real_time_factor': seconds / audio_seconds if audio_seconds > 0 else None,
+    }
+    res.update(extra)
+    print(f'{name:<40} {seconds:9.3f} s  {res["files_per_second"] or 0:9.2f} files/s  RTF {res["real_time_factor"] or 0:.4f}')
+
+    return res
+
+def run(argv, workdir: str):
+    results = []
+
+    for sr in argv.sample_rates:
+        dataset = os.path.join(workdir, f'spk-{sr}')
+        make_corpus(dataset, sr, argv.files, argv.seconds)
+        n_files = argv.files * len(speakers)
+        audio_seconds = n_files * argv.seconds
+
+        start = time.perf_counter()
+        for _ in load_wavs(dataset, sr):
+            pass
+        results.append(report(f'load_wavs@{sr}', time.perf_counter() - start, n_files, audio_seconds))
+
+        for f0_method in argv.f0_methods:
+            for workers in argv.workers:
+                processed = os.path.join(workdir, f'processed-{sr}')
+                timer = StageTimer()
+                start = time.perf_counter()
+                wav_to_mcep_file(dataset, sr, processed_filepath=processed, workers=workers,
+                    cache_dir='', f0_method=f0_method, timer=timer, dtype=argv.dtypes[0])
+                seconds = time.perf_counter() - start
+                results.append(report(f'extract@{sr}/{f0_method}/workers={workers}', seconds, n_files, timer.audio_seconds,
+                    stages=timer.summary()['stages']))
+
+        # Storage formats: repack the store in every dtype, then cut every FRAMES window out of it.
+        for dtype in argv.dtypes:
+            rebuild_features(processed, dtype)
+            store_bytes = os.path.getsize(os.path.join(processed, f'{FEATURES}.bin'))
+            start = time.perf_counter()
+            index, store = load_features(processed)
+            n_segs = 0
+            for offset, frames in zip(index['offsets'], index['frames']):
+                for start_idx in range(0, frames - FRAMES + 1, FRAMES):
+                    one_seg = np.array(store[offset + start_idx: offset + start_idx + FRAMES].T, dtype=np.float32)
+                    n_segs += 1
+            feature_seconds = int(np.sum(index['frames'])) * SHIFTMS / 1000
+            results.append(report(f'segments@{sr}/{dtype}', time.perf_counter() - start, n_files, feature_seconds,
+                segments=n_segs, store_bytes=store_bytes))
+            print(f'{"":<40} store: {store_bytes / 2 ** 20:.2f} MiB')
+
+        start = time.perf_counter()
+        GenerateStatistics(processed).generate_stats(os.path.join(workdir, f'etc-{sr}'))
+        results.append(report(f'statistics@{sr}', time.perf_counter() - start, n_files, feature_seconds))
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark preprocessing on synthetic audio.')
+
+    parser.add_argument('--sample_rates', type=int, nargs='+', default=[16000, 22050], help='Sample rates to test.')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Length of every synthetic wav in seconds.')
+    parser.add_argument('--files', type=int, default=4, help='Number of wavs per speaker.')
+    parser.add_argument('--f0_methods', type=str, nargs='+', default=F0_METHODS, choices=F0_METHODS, help='F0 estimators to compare.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1], help='Worker counts to compare.')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=FEATURE_DTYPES, choices=FEATURE_DTYPES, 
+        help='Storage types of the feature store to compare (size and segment read time).')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results to this file.')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary working directory.')
+
+    argv = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='starganvc2-bench-')
+    try:
+        results = run(argv, workdir)
+    finally:
+        if argv.keep:
+            print(f'* Working directory: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f'[SAVE]: {argv.output}')
@@ -2,69 +2,401 @@ import glob
 import librosa
 import numpy as np
 import os
+import queue
 from sklearn.preprocessing import LabelBinarizer
+import threading
 import torch
 from torch.utils.data.dataloader import DataLoader
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import BatchSampler, RandomSampler, Sampler, SequentialSampler
 
-from preprocess import ALPHA, FEATURE_DIM, FFTSIZE, FRAMES, SHIFTMS
-from utility import Normalizer, speakers, cal_mcep
+from preprocess import ALPHA, CACHE_VERSION, FEATURE_DIM, FFTSIZE, FRAMES, SHIFTMS
+from utility import Normalizer, speakers, cal_mcep, file_digest, load_features, load_wav_manifest
 from random import choice
 
 class AudioDataset(Dataset):
-    def __init__(self, data_dir: str):
+    """
+        Fixed-length segments cut on the fly from the packed utterance store.
+        A segment is an (utterance, start) entry; `hop` < `frames` gives overlapping crops.
+    """
+
+    def __init__(self, data_dir: str, frames: int=FRAMES, hop: int=None):
         super(AudioDataset, self).__init__()
         self.data_dir = data_dir
-        self.files = librosa.util.find_files(data_dir, ext='npy')
+        self.frames = frames
+        self.hop = hop or frames
+        self.index, _ = load_features(data_dir)
+        self.store = None
         self.encoder = LabelBinarizer().fit(speakers)
 
+        # Every utterance of n frames contributes the starts 0, hop, ... <= n - frames.
+        n_segs = np.maximum(self.index['frames'] - self.frames, -1) // self.hop + 1
+        self.seg_utt = np.repeat(np.arange(len(n_segs)), n_segs)
+        first_seg = np.cumsum(n_segs) - n_segs
+        self.seg_start = (np.arange(len(self.seg_utt)) - first_seg[self.seg_utt]) * self.hop
+
+        # Labels are looked up per item, precompute them instead of calling the encoder.
+        self.seg_speaker = torch.from_numpy(self.index['speaker_idx'][self.seg_utt])
+        self.label_table = torch.FloatTensor(self.encoder.transform(speakers))
+
+        # The store is unnormalized; keep per-speaker (feature_dim, 1) mean/std.
+        norm = Normalizer()
+        self.mcep_mean = [np.reshape(norm.norm_dict[s]['mcep_mean'], [-1, 1]).astype(np.float32) for s in speakers]
+        self.mcep_std = [np.reshape(norm.norm_dict[s]['mcep_std'], [-1, 1]).astype(np.float32) for s in speakers]
+
     def __getitem__(self, idx):
-        p = self.files[idx]
-        filename = os.path.basename(p)
-        speaker = filename.split(sep='_', maxsplit=1)[0]
-        label = self.encoder.transform([speaker])[0]
-        mcep = np.load(p)
+        if self.store is None:
+            # Opened lazily so every DataLoader worker maps the file itself.
+            _, self.store = load_features(self.data_dir)
+        offset = self.index['offsets'][self.seg_utt[idx]] + self.seg_start[idx]
+        speaker_idx = self.seg_speaker[idx]
+        mcep = self.store[offset: offset + self.frames].T
+        mcep = (mcep - self.mcep_mean[speaker_idx]) / self.mcep_std[speaker_idx]
         mcep = torch.FloatTensor(mcep)
         mcep = torch.unsqueeze(mcep, 0)
-        return mcep, torch.tensor(speakers.index(speaker), dtype=torch.long), torch.FloatTensor(label)
+        return mcep, speaker_idx, self.label_table[speaker_idx]
 
     def speaker_encoder(self):
         return self.encoder
 
     def __len__(self):
-        return len(self.files)
+        return len(self.seg_utt)
+
+class SpeakerBalancedBatchSampler(Sampler):
+    """
+        Yield batches of indices with the same number of segments from every speaker
+        (the remainder of `batch_size` goes to randomly chosen speakers).
+        The segments of each speaker are reshuffled whenever they run out, so small
+        speakers are repeated rather than drowned out by large ones.
+    """
+
+    def __init__(self, speaker_idx, batch_size: int):
+        self.pools = [torch.nonzero(speaker_idx == s).flatten() for s in torch.unique(speaker_idx)]
+        self.batch_size = batch_size
+        self.num_batches = max(len(speaker_idx) // batch_size, 1)
+
+    def __iter__(self):
+        num_speakers = len(self.pools)
+        orders = [p[torch.randperm(len(p))] for p in self.pools]
+        pos = [0] * num_speakers
+
+        for _ in range(self.num_batches):
+            counts = [self.batch_size // num_speakers] * num_speakers
+            for s in torch.randperm(num_speakers)[: self.batch_size % num_speakers].tolist():
+                counts[s] += 1
+
+            batch = []
+            for s, cnt in enumerate(counts):
+                while cnt > 0:
+                    if pos[s] == len(orders[s]):
+                        orders[s] = self.pools[s][torch.randperm(len(self.pools[s]))]
+                        pos[s] = 0
+                    taken = orders[s][pos[s]: pos[s] + cnt]
+                    batch.extend(taken.tolist())
+                    pos[s] += len(taken)
+                    cnt -= len(taken)
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
+
+class InfiniteBatchSampler(Sampler):
+    """
+        Repeat `batch_sampler` forever, so a DataLoader is iterated once and its
+        (persistent) workers are never respawned. `epoch` counts the completed passes;
+        `batch_sampler` reshuffles at the start of each one.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.epoch = 0
+
+    def __iter__(self):
+        while True:
+            for batch in self.batch_sampler:
+                yield batch
+            self.epoch += 1
+
+    def __len__(self):
+        # Batches per epoch.
+        return len(self.batch_sampler)
+
+def load_normalized(dataset: AudioDataset):
+    """
+        Return the whole store of `dataset`, normalized per speaker, as one
+        contiguous float32 tensor of (total_frames, feature_dim).
+    """
+
+    index, store = load_features(dataset.data_dir)
+    frames = torch.empty(store.shape, dtype=torch.float32)
+    for offset, n, speaker_idx in zip(index['offsets'], index['frames'], index['speaker_idx']):
+        one_utt = (store[offset: offset + n] - dataset.mcep_mean[speaker_idx].T) / dataset.mcep_std[speaker_idx].T
+        frames[offset: offset + n] = torch.from_numpy(one_utt.astype(np.float32))
+
+    return frames
+
+class InMemoryLoader(object):
+    """
+        Serve the segments of an `AudioDataset` from memory.
+        The whole store is normalized once into one contiguous float32 tensor of
+        (total_frames, feature_dim); a batch is a single index gather of its windows,
+        so no DataLoader workers are needed. Iteration never ends; `epoch` counts the passes.
+    """
+
+    def __init__(self, dataset: AudioDataset, batch_size=4, shuffle=True, batch_sampler=None):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+
+        index, _ = load_features(dataset.data_dir)
+        self.frames = load_normalized(dataset)
+
+        self.starts = torch.from_numpy(index['offsets'][dataset.seg_utt] + dataset.seg_start)
+        self.window = torch.arange(dataset.frames)
+        self.speaker_idx = dataset.seg_speaker
+        self.label_table = dataset.label_table
+        self.epoch = 0
+
+    def batch(self, idx):
+        rows = self.starts[idx].unsqueeze(1) + self.window # (batch, frames)
+        mcep = self.frames[rows].transpose(1, 2).unsqueeze(1) # (batch, 1, feature_dim, frames)
+        speaker_idx = self.speaker_idx[idx]
+        return mcep, speaker_idx, self.label_table[speaker_idx]
+
+    def __iter__(self):
+        n = len(self.starts)
+        while True:
+            if self.batch_sampler is not None:
+                for idx in self.batch_sampler:
+                    yield self.batch(torch.as_tensor(idx))
+            else:
+                order = torch.randperm(n) if self.shuffle else torch.arange(n)
+                for i in range(0, n, self.batch_size):
+                    yield self.batch(order[i: i + self.batch_size])
+            self.epoch += 1
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return (len(self.starts) + self.batch_size - 1) // self.batch_size
+
+class RandomCropLoader(object):
+    """
+        Sample random `crop_frames`-long crops of the full utterances at batch time.
+        Every crop position of every utterance is equally likely, so the crop length can
+        change without reprocessing. Crops are gathered from the in-memory tensor
+        (`in_memory`) or straight from the memory-mapped store and normalized per batch.
+        One epoch is as many crops as fit in the data without overlap; iteration never ends
+        and `epoch` counts the passes.
+        With `balanced` every batch holds the same number of crops of every speaker.
+    """
+
+    def __init__(self, dataset: AudioDataset, batch_size=4, crop_frames=FRAMES, in_memory=False, balanced=False):
+        # The generator down-samples the time axis twice by 2.
+        assert crop_frames % 4 == 0, 'crop_frames must be a multiple of 4.'
+        self.data_dir = dataset.data_dir
+        self.batch_size = batch_size
+        self.crop_frames = crop_frames
+        self.balanced = balanced
+
+        index, _ = load_features(dataset.data_dir)
+        valid = np.flatnonzero(index['frames'] >= crop_frames)
+        self.offsets = torch.from_numpy(index['offsets'][valid])
+        self.n_starts = torch.from_numpy(index['frames'][valid] - crop_frames + 1)
+        self.speaker_idx = torch.from_numpy(index['speaker_idx'][valid])
+        self.num_crops = int(np.sum(index['frames'][valid] // crop_frames))
+        self.window = torch.arange(crop_frames)
+        self.label_table = dataset.label_table
+
+        self.mcep_mean = np.stack([m[:, 0] for m in dataset.mcep_mean])[:, None, :] # (speakers, 1, feature_dim)
+        self.mcep_std = np.stack([s[:, 0] for s in dataset.mcep_std])[:, None, :]
+        self.frames = load_normalized(dataset) if in_memory else None
+        self.store = None
+        self.epoch = 0
+
+    def sample(self):
+        if self.balanced:
+            present = torch.unique(self.speaker_idx)
+            slots = present[torch.randperm(len(present))].repeat(self.batch_size // len(present) + 1)[: self.batch_size]
+            weights = self.n_starts.double() * (self.speaker_idx.unsqueeze(0) == slots.unsqueeze(1)) # (batch, utterances)
+            utt = torch.multinomial(weights, 1).squeeze(1)
+        else:
+            utt = torch.multinomial(self.n_starts.double(), self.batch_size, replacement=True)
+        start = (torch.rand(self.batch_size, dtype=torch.float64) * self.n_starts[utt]).long()
+        rows = (self.offsets[utt] + start).unsqueeze(1) + self.window # (batch, crop_frames)
+        speaker_idx = self.speaker_idx[utt]
+
+        if self.frames is not None:
+            mcep = self.frames[rows]
+        else:
+            if self.store is None:
+                _, self.store = load_features(self.data_dir)
+            spk = speaker_idx.numpy()
+            mcep = (self.store[rows.numpy()] - self.mcep_mean[spk]) / self.mcep_std[spk]
+            mcep = torch.from_numpy(mcep.astype(np.float32))
+
+        mcep = mcep.transpose(1, 2).unsqueeze(1) # (batch, 1, feature_dim, crop_frames)
+        return mcep, speaker_idx, self.label_table[speaker_idx]
+
+    def __iter__(self):
+        while True:
+            for _ in range(len(self)):
+                yield self.sample()
+            self.epoch += 1
+
+    def __len__(self):
+        return max(self.num_crops // self.batch_size, 1)
+
+class DataPrefetcher(object):
+    """
+        Pull batches from `loader` in a background thread and keep up to `num_prefetch` of them
+        ready on `device`. On CUDA every batch is pinned and copied on a side stream as soon
+        as it is loaded, so the copies of the next batches overlap the training step on the
+        default stream; `next` only makes the current stream wait for that batch's copy.
+        Stops when `loader` is exhausted; exceptions raised while loading are re-raised by `next`.
+    """
+
+    _END = object()
+
+    def __init__(self, loader, device, num_prefetch: int=2):
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self.queue = queue.Queue(maxsize=max(num_prefetch, 1))
+        self.done = False
+        self.thread = threading.Thread(target=self._fill, args=(loader,), daemon=True)
+        self.thread.start()
 
-def data_loader(data_dir: str, batch_size=4, shuffle=True, mode='train', num_workers=2):
-    dataset = AudioDataset(data_dir)
-    loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+    def _fill(self, loader):
+        try:
+            for batch in loader:
+                event = None
+                if self.stream is not None:
+                    batch = [x.pin_memory() for x in batch]
+                    with torch.cuda.stream(self.stream):
+                        batch = [x.to(self.device, non_blocking=True) for x in batch]
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = [x.to(self.device) for x in batch]
+                self.queue.put((batch, event))
+            self.queue.put(self._END)
+        except Exception as e:
+            # Re-raised in the consuming thread.
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        item = self.queue.get()
+        if item is self._END:
+            self.done = True
+            raise StopIteration
+        if isinstance(item, Exception):
+            self.done = True
+            raise item
+
+        batch, event = item
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for x in batch:
+                # Allocated on the side stream, used on the current one.
+                x.record_stream(current)
+        return batch
+
+def data_loader(data_dir: str, batch_size=4, shuffle=True, mode='train', num_workers=2, hop=None, in_memory=False,
+    crop_frames=None, balanced=False, prefetch_factor=2):
+    """
+        Build the training loader. Every variant yields batches forever (epoch after epoch),
+        so it is iterated once and DataLoader workers stay alive for the whole run.
+    """
+
+    dataset = AudioDataset(data_dir, hop=hop)
+    if crop_frames:
+        return RandomCropLoader(dataset, batch_size=batch_size, crop_frames=crop_frames, in_memory=in_memory,
+            balanced=balanced)
+
+    batch_sampler = SpeakerBalancedBatchSampler(dataset.seg_speaker, batch_size) if balanced else None
+    if in_memory:
+        return InMemoryLoader(dataset, batch_size=batch_size, shuffle=shuffle, batch_sampler=batch_sampler)
+    if batch_sampler is None:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size, drop_last=False)
+
+    workers = {}
+    if num_workers > 0:
+        workers = dict(persistent_workers=True, prefetch_factor=prefetch_factor)
+    loader = DataLoader(dataset, batch_sampler=InfiniteBatchSampler(batch_sampler), num_workers=num_workers, **workers)
     
     return loader
 
 class TestSet(object):
-    def __init__(self, data_dir: str, sr: int):
+    """
+        Features of the test wavs, extracted once per speaker and kept in memory.
+        With `cache_dir` every file's (f0, ap, mcep) is also stored on disk, keyed by
+        the file content and the extraction parameters, and reused by later runs.
+    """
+
+    def __init__(self, data_dir: str, sr: int, f0_method: str='harvest', cache_dir: str=None):
         super(TestSet, self).__init__()
         self.data_dir = data_dir
         self.norm = Normalizer()
         self.sample_rate = sr
+        self.f0_method = f0_method
+        self.cache_dir = cache_dir
+        self.wavfiles = load_wav_manifest(data_dir)
+        self.features = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
         
     def choose(self):
         r = choice(speakers)
         return r
+
+    def extract(self, wavfile: str):
+        """
+            Return `(f0, ap, mcep)` of one wav file, from the disk cache if possible.
+        """
+
+        cache_path = None
+        if self.cache_dir:
+            key = file_digest([wavfile], 'test', CACHE_VERSION, self.sample_rate, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA, self.f0_method)
+            cache_path = os.path.join(self.cache_dir, f'{key}.npz')
+            if os.path.exists(cache_path):
+                t = np.load(cache_path)
+                return t['f0'], t['ap'], t['mcep']
+
+        wav, _ = librosa.load(wavfile, sr=self.sample_rate, dtype=np.float64)
+        f0, ap, mcep = cal_mcep(wav, self.sample_rate, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA, self.f0_method)
+
+        if cache_path:
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, f0=f0, ap=ap, mcep=mcep)
+            os.replace(tmp_path, cache_path)
+
+        return f0, ap, mcep
     
     def test_data(self, src_speaker=None):
         if src_speaker:
             r_s = src_speaker
         else:
             r_s = self.choose()
+
+        if r_s in self.features:
+            return self.features[r_s], r_s
             
-        p = os.path.join(self.data_dir, r_s)
-        wavfiles = librosa.util.find_files(p, ext='wav')
+        if r_s not in self.wavfiles:
+            self.wavfiles = load_wav_manifest(self.data_dir, rebuild=True)
+        wavfiles = self.wavfiles.get(r_s, [])
        
         res = {}
         for f in wavfiles:
             filename = os.path.basename(f)
-            wav, _ = librosa.load(f, sr=self.sample_rate, dtype=np.float64)
-            f0, ap, mcep = cal_mcep(wav, self.sample_rate, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA)
+            f0, ap, mcep = self.extract(f)
             mcep_norm = self.norm.forward_process(mcep, r_s)
 
             if not res.__contains__(filename):
@@ -72,4 +404,5 @@ class TestSet(object):
             res[filename]['mcep_norm'] = np.asarray(mcep_norm)
             res[filename]['f0'] = np.asarray(f0)
             res[filename]['ap'] = np.asarray(ap)
+        self.features[r_s] = res
         return res, r_s    
@@ -25,7 +25,9 @@ def main(config):
     if not os.path.exists(config.result_dir):
         os.makedirs(config.result_dir)
 
-    data_loader_ = data_loader(config.data_dir, batch_size=config.batch_size, mode=config.mode, num_workers=config.num_workers)
+    data_loader_ = data_loader(config.data_dir, batch_size=config.batch_size, mode=config.mode, num_workers=config.num_workers,
+        hop=config.hop, in_memory=config.in_memory, crop_frames=config.crop_frames,
+        balanced=config.balanced, prefetch_factor=config.prefetch_factor)
 
     solver = Solver(data_loader_, config)
 
@@ -44,6 +46,11 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, default=dataset_default, choices=['VCC2016', 'VCC2018'], 
         help='Available datasets: VCC2016 and VCC2018 (Default: VCC2016).')
     
+    parser.add_argument('--residual_depth', type=int, default=9, help='Number of residual steps in the generator bottleneck.')
+    parser.add_argument('--bottleneck_dim', type=int, default=256, help='Channels of the generator bottleneck.')
+    parser.add_argument('--residual_shared', type=str2bool, default=True, 
+        help='Allocate two residual blocks and run them as 0, 1, 0, 0, ... (original schedule); otherwise one block per step.')
+
     parser.add_argument('--lambda_cyc', type=float, default=10, help='Weight of cycle loss.')
     parser.add_argument('--lambda_gp', type=float, default=5, help='Weight of gradient penalty.')
     parser.add_argument('--lambda_id', type=float, default=5, help='Weight of identity loss.')
@@ -64,11 +71,23 @@ if __name__ == '__main__':
     parser.add_argument('--trg_speaker', type=str, default="['TM1', 'SF1']", help='String list representation of target speakers eg. "[a,b]".')
 
     parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded in advance by each DataLoader worker.')
+    parser.add_argument('--in_memory', type=str2bool, default=False, 
+        help='Keep the whole normalized training set in memory and batch without DataLoader workers.')
+    parser.add_argument('--balanced', type=str2bool, default=False, 
+        help='Draw the same number of segments of every speaker into each batch.')
+    parser.add_argument('--crop_frames', type=int, default=None, 
+        help='Train on random crops of this many frames (multiple of 4) sampled from full utterances.')
+    parser.add_argument('--hop', type=int, default=None, help='Hop between training segments in frames (Default: segment length).')
+    parser.add_argument('--prefetch', type=int, default=2, 
+        help='Number of batches a background thread keeps ready on the training device (0: load synchronously).')
     parser.add_argument('--mode', type=str, default='train', choices=['train', 'convert'])
     parser.add_argument('--use_tensorboard', type=str2bool, default=True)
 
     parser.add_argument('--data_dir', type=str, default='data/processed')
     parser.add_argument('--test_dir', type=str, default='data/spk_test')
+    parser.add_argument('--test_cache_dir', type=str, default='data/cache/test', 
+        help='Cache of test-set features keyed by file content and feature parameters (empty to disable).')
     parser.add_argument('--log_dir', type=str, default='outputs/logs')
     parser.add_argument('--model_save_dir', type=str, default='outputs/models')
     parser.add_argument('--sample_dir', type=str, default='outputs/samples')
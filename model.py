@@ -1,65 +1,59 @@
 import argparse
 import numpy as np
+import re
 import torch
 import torch.nn as nn
 
 class DownsampleBlock(nn.Module):
+    """
+        Gated down-sampling block. The layer and gate branches are computed by one
+        convolution with 2 * dim_out channels (first half: layer, second half: gate).
+    """
+
     def __init__(self, dim_in, dim_out, kernel_size, stride, padding, bias):
         super(DownsampleBlock, self).__init__()
 
         self.conv_layer = nn.Sequential(
             nn.Conv2d(in_channels=dim_in,
-                      out_channels=dim_out,
-                      kernel_size=kernel_size,
-                      stride=stride,
-                      padding=padding,
-                      bias=bias),
-            nn.InstanceNorm2d(num_features=dim_out, affine=True),
-            nn.GLU(dim=1)
-        )
-        self.conv_gated = nn.Sequential(
-            nn.Conv2d(in_channels=dim_in,
-                      out_channels=dim_out,
+                      out_channels=dim_out * 2,
                       kernel_size=kernel_size,
                       stride=stride,
                       padding=padding,
                       bias=bias),
-            nn.InstanceNorm2d(num_features=dim_out, affine=True),
-            nn.GLU(dim=1)
+            nn.InstanceNorm2d(num_features=dim_out * 2, affine=True)
         )
+        self.glu = nn.GLU(dim=1)
 
     def forward(self, x):
         # GLU
-        return self.conv_layer(x) * torch.sigmoid(self.conv_gated(x))
+        x, gate = torch.chunk(self.conv_layer(x), chunks=2, dim=1)
+        return self.glu(x) * torch.sigmoid(self.glu(gate))
 
 class UpSampleBlock(nn.Module):
+    """
+        Gated up-sampling block, fused like `DownsampleBlock`. PixelShuffle(2) merges
+        groups of 4 consecutive channels, so with dim_out divisible by 4 the layer and
+        gate halves stay separate after the shuffle.
+    """
+
     def __init__(self, dim_in, dim_out, kernel_size, stride, padding, bias):
         super(UpSampleBlock, self).__init__()
 
         self.conv_layer = nn.Sequential(
             nn.ConvTranspose2d(in_channels=dim_in,
-                               out_channels=dim_out,
-                               kernel_size=kernel_size,
-                               stride=stride,
-                               padding=padding,
-                               bias=bias),
-            nn.PixelShuffle(2),
-            nn.GLU(dim=1)
-        )
-        self.conv_gated = nn.Sequential(
-            nn.ConvTranspose2d(in_channels=dim_in,
-                               out_channels=dim_out,
+                               out_channels=dim_out * 2,
                                kernel_size=kernel_size,
                                stride=stride,
                                padding=padding,
                                bias=bias),
-            nn.PixelShuffle(2),
-            nn.GLU(dim=1)
+            nn.PixelShuffle(2)
         )
+        self.glu = nn.GLU(dim=1)
 
     def forward(self, x):
         # GLU
-        return self.conv_layer(x) * torch.sigmoid(self.conv_gated(x))
+        x, gate = torch.chunk(self.conv_layer(x), chunks=2, dim=1)
+        return self.glu(x) * torch.sigmoid(self.glu(gate))
 
 class AdaptiveInstanceNormalization(nn.Module):
     """
@@ -69,12 +63,11 @@ class AdaptiveInstanceNormalization(nn.Module):
     def __init__(self, dim_in, style_num):
         super(AdaptiveInstanceNormalization, self).__init__()
 
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
         self.fc = nn.Linear(style_num, dim_in * 2)
 
-    def forward(self, x, c):
-        h = self.fc(c)
+    def forward(self, x, c, style=None):
+        # `style`: precomputed self.fc(c), see Generator.build_style_tables.
+        h = self.fc(c) if style is None else style
         #print (h.shape)
         h = h.view(h.size(0), h.size(1), 1)
         #print (h.shape)
@@ -97,8 +90,6 @@ class ConditionalInstanceNormalisation(nn.Module):
     def __init__(self, dim_in, style_num):
         super(ConditionalInstanceNormalisation, self).__init__()
 
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-
         self.dim_in = dim_in
         self.style_num = style_num
         self.gamma = nn.Linear(style_num, dim_in)
@@ -109,9 +100,9 @@ class ConditionalInstanceNormalisation(nn.Module):
         var = torch.mean((x - u) * (x - u), dim=2, keepdim=True)
         std = torch.sqrt(var + 1e-8)
 
-        gamma = self.gamma(c.to(self.device))
+        gamma = self.gamma(c)
         gamma = gamma.view(-1, self.dim_in, 1)
-        beta = self.beta(c.to(self.device))
+        beta = self.beta(c)
         beta = beta.view(-1, self.dim_in, 1)
 
         h = (x - u) / std
@@ -132,19 +123,27 @@ class ResidualBlock(nn.Module):
         # self.cin = ConditionalInstanceNormalisation(dim_in=dim_out, style_num=style_num)
         self.glu = nn.GLU(dim=1)
 
-    def forward(self, x, c_):
+    def forward(self, x, c_, style=None):
         x_ = self.conv_layer(x)
-        x_ = self.adain(x_, c_)
+        x_ = self.adain(x_, c_, style)
         x_ = self.glu(x_)
 
         return x + x_
 
 class Generator(nn.Module):
-    def __init__(self, num_speakers=4):
+    """
+        StarGAN-VC2 generator. The bottleneck runs `residual_depth` residual blocks with
+        `bottleneck_dim` channels. With `residual_shared` only two blocks are allocated and
+        run in the order 0, 1, 0, 0, ... (the schedule of the original implementation);
+        otherwise every step has its own block.
+    """
+
+    def __init__(self, num_speakers=4, residual_depth=9, bottleneck_dim=256, residual_shared=True):
         super(Generator, self).__init__()
 
         self.num_speakers = num_speakers
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.style_tables = None
+        self.style_versions = None
 
         # Initial layers.
         self.conv_layer_1 = nn.Sequential(
@@ -171,72 +170,31 @@ class Generator(nn.Module):
         # Down-conversion layers.
         self.down_conversion = nn.Sequential(
             nn.Conv1d(in_channels=2304,
-                      out_channels=256,
+                      out_channels=bottleneck_dim,
                       kernel_size=1,
                       stride=1,
                       padding=0,
                       bias=False),
-            nn.InstanceNorm1d(num_features=256, affine=True)
+            nn.InstanceNorm1d(num_features=bottleneck_dim, affine=True)
         )
 
         # Bottleneck layers.
-        self.residual_1 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_2 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_3 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_4 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_5 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_6 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_7 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_8 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
-        self.residual_9 = ResidualBlock(dim_in=256,
-                                        dim_out=512,
-                                        kernel_size=5,
-                                        stride=1,
-                                        padding=2,
-                                        style_num=self.num_speakers * 2)
+        if residual_depth < 1:
+            raise ValueError(f'residual_depth must be at least 1, got {residual_depth}.')
+        if residual_shared:
+            self.schedule = [0, 1][: residual_depth] + [0] * max(residual_depth - 2, 0)
+        else:
+            self.schedule = list(range(residual_depth))
+        self.residuals = nn.ModuleList([ResidualBlock(dim_in=bottleneck_dim,
+                                                      dim_out=bottleneck_dim * 2,
+                                                      kernel_size=5,
+                                                      stride=1,
+                                                      padding=2,
+                                                      style_num=self.num_speakers * 2)
+                                        for _ in range(max(self.schedule) + 1)])
 
         # Up-conversion layers.
-        self.up_conversion = nn.Conv1d(in_channels=256,
+        self.up_conversion = nn.Conv1d(in_channels=bottleneck_dim,
                                        out_channels=2304,
                                        kernel_size=1,
                                        stride=1,
@@ -267,8 +225,12 @@ class Generator(nn.Module):
                              padding=(2, 7),
                              bias=False)
 
-    def forward(self, x, c, c_):
-        c_onehot = torch.cat((c, c_), dim=1).to(self.device)
+    def encode(self, x):
+        """
+            Speaker-independent half: initial layers, down-sampling and down-conversion.
+            Returns a (batch, bottleneck_dim, width // 4) tensor.
+        """
+
         width_size = x.size(3)
         #print (x.shape)
         x = self.conv_layer_1(x)
@@ -281,25 +243,27 @@ class Generator(nn.Module):
         #print (x.shape)
         x = self.down_conversion(x)
         #print (x.shape)
+        return x
 
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_2(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
-        x = self.residual_1(x, c_onehot)
-        #print (x.shape)
+    def decode(self, x, c, c_, pair=None):
+        """
+            Conditioned half: bottleneck with source codes `c` and target codes `c_`,
+            then up-conversion and up-sampling of the output of `encode`.
+            With `pair` (source * num_speakers + target per sample) the AdaIN parameters
+            are looked up in the tables of `build_style_tables` instead; `c`, `c_` are unused.
+        """
+
+        if pair is None:
+            c_onehot = torch.cat((c, c_), dim=1)
+            styles = [None] * len(self.residuals)
+        else:
+            c_onehot = None
+            styles = [table[pair] for table in self.current_style_tables()]
+        width_size = x.size(2) * 4
+
+        for k in self.schedule:
+            x = self.residuals[k](x, c_onehot, styles[k])
+            #print (x.shape)
 
         x = self.up_conversion(x)
         #print (x.shape)
@@ -317,22 +281,84 @@ class Generator(nn.Module):
         #print (out.shape)
         return out_reshaped
 
+    def forward(self, x, c, c_):
+        return self.decode(self.encode(x), c, c_)
+
+    def forward_targets(self, x, c, targets):
+        """
+            Convert `x` with source codes `c` to every code batch in `targets`.
+            `x` is encoded once; all targets are decoded together as one batch.
+            Returns one output per element of `targets`.
+        """
+
+        n = len(targets)
+        h = self.encode(x)
+        out = self.decode(h.repeat(n, 1, 1), c.repeat(n, 1), torch.cat(targets, dim=0))
+        return torch.chunk(out, n, dim=0)
+
+    def build_style_tables(self):
+        """
+            Precompute the AdaIN gamma/beta of every residual block for all
+            (source, target) speaker pairs, row source * num_speakers + target.
+            The tables are rebuilt on use whenever the fc weights have changed since
+            (loading a checkpoint, optimizer steps), see `current_style_tables`.
+        """
+
+        n = int(self.num_speakers)
+        weight = self.residuals[0].adain.fc.weight
+        eye = torch.eye(n, dtype=weight.dtype, device=weight.device)
+        src, trg = torch.arange(n).repeat_interleave(n), torch.arange(n).repeat(n)
+        codes = torch.cat((eye[src], eye[trg]), dim=1) # (n * n, 2 * n)
+        with torch.no_grad():
+            self.style_tables = [block.adain.fc(codes) for block in self.residuals]
+        self.style_versions = self._style_versions()
+
+    def _style_versions(self):
+        # In-place updates (optimizer steps, load_state_dict) bump a tensor's version counter.
+        return [p._version for block in self.residuals for p in block.adain.fc.parameters()]
+
+    def current_style_tables(self):
+        """
+            Return the style tables, rebuilt first if they are missing or stale.
+        """
+
+        if self.style_tables is None or self.style_versions != self._style_versions():
+            self.build_style_tables()
+        return self.style_tables
+
+    def load_state_dict(self, *args, **kwargs):
+        self.style_tables = None
+        return super(Generator, self).load_state_dict(*args, **kwargs)
+
+    def _apply(self, fn, *args, **kwargs):
+        # The style tables are plain tensors, not buffers; drop them when the module
+        # is moved or cast so they are rebuilt next to the parameters.
+        self.style_tables = None
+        return super(Generator, self)._apply(fn, *args, **kwargs)
+
+    def forward_indices(self, x, src, targets):
+        """
+            Inference: convert `x` of speaker index `src` to every speaker index in `targets`
+            like `forward_targets`, with the AdaIN parameters taken from the style tables.
+        """
+
+        n = len(targets)
+        trg = torch.as_tensor(targets, dtype=torch.long, device=x.device).repeat_interleave(x.size(0))
+        h = self.encode(x)
+        out = self.decode(h.repeat(n, 1, 1), None, None, pair=src * int(self.num_speakers) + trg)
+        return torch.chunk(out, n, dim=0)
+
 class Discriminator(nn.Module):
     def __init__(self, num_speakers=4):
         super(Discriminator, self).__init__()
 
         self.num_speakers = num_speakers
-        self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-        # Initial layers.
+        # Initial layers (layer and gate branches in one convolution).
         self.conv_layer_1 = nn.Sequential(
-            nn.Conv2d(in_channels=1, out_channels=128, kernel_size=(3, 3), stride=(1, 1), padding=1),
-            nn.GLU(dim=1)
-        )
-        self.conv_gated_1 = nn.Sequential(
-            nn.Conv2d(in_channels=1, out_channels=128, kernel_size=(3, 3), stride=(1, 1), padding=1),
-            nn.GLU(dim=1)
+            nn.Conv2d(in_channels=1, out_channels=256, kernel_size=(3, 3), stride=(1, 1), padding=1)
         )
+        self.glu = nn.GLU(dim=1)
 
         # Down-sampling layers.
         self.down_sample_1 = DownsampleBlock(dim_in=64,
@@ -367,9 +393,10 @@ class Discriminator(nn.Module):
         self.projection = nn.Linear(self.num_speakers * 2, 512)
 
     def forward(self, x, c, c_):
-        c_onehot = torch.cat((c, c_), dim=1).to(self.device)
+        c_onehot = torch.cat((c, c_), dim=1)
         #print (x.shape)
-        x = self.conv_layer_1(x) * torch.sigmoid(self.conv_gated_1(x))
+        x, gate = torch.chunk(self.conv_layer_1(x), chunks=2, dim=1)
+        x = self.glu(x) * torch.sigmoid(self.glu(gate))
         #print (x.shape)
 
         x = self.down_sample_1(x)
@@ -391,3 +418,74 @@ class Discriminator(nn.Module):
         x += torch.sum(p * h, dim=1, keepdim=True)
         #print (x.shape)
         return x
+
+# Blocks run by the generator before the residual stack became configurable:
+# residual_1, residual_2, then residual_1 again (residual_3..9 were never used).
+LEGACY_SCHEDULE = [1, 2, 1, 1, 1, 1, 1, 1, 1]
+
+def upgrade_state_dict(state_dict, model: nn.Module):
+    """
+        Map an older checkpoint onto `model`:
+        every `conv_gated*` tensor is appended to its `conv_layer*` counterpart along
+        the output-channel axis (from before the gated convolutions were fused), and
+        `residual_1`..`residual_9` are replaced by `residuals` (see `LEGACY_SCHEDULE`).
+        Current checkpoints are returned unchanged.
+    """
+
+    target = model.state_dict()
+    res = {}
+    legacy = False
+    for key, value in state_dict.items():
+        if 'conv_gated' in key:
+            continue
+        if re.match(r'residual_\d+\.', key):
+            legacy = True
+            continue
+        gated_key = key.replace('conv_layer', 'conv_gated')
+        if gated_key != key and gated_key in state_dict and key in target and target[key].shape != value.shape:
+            # Output channels are dim 0 of Conv2d/InstanceNorm and dim 1 of ConvTranspose2d weights.
+            dim = [i for i, (a, b) in enumerate(zip(target[key].shape, value.shape)) if a != b][0]
+            value = torch.cat((value, state_dict[gated_key]), dim=dim)
+        res[key] = value
+
+    if legacy:
+        # Fill every block from the old block that ran at the first step using it,
+        # so the converted model computes the same function as the old one.
+        for k in range(len(model.residuals)):
+            step = model.schedule.index(k)
+            prefix = f'residual_{LEGACY_SCHEDULE[min(step, len(LEGACY_SCHEDULE) - 1)]}.'
+            for key, value in state_dict.items():
+                if key.startswith(prefix):
+                    res[f'residuals.{k}.{key[len(prefix):]}'] = value
+
+    return res
+
+def str2bool(v):
+    return v.lower() in ('true')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert an older checkpoint to the current model layout.')
+
+    parser.add_argument('--input', type=str, required=True, help='Checkpoint to convert, e.g. outputs/models/200000-G.ckpt.')
+    parser.add_argument('--output', type=str, required=True, help='Where to save the converted checkpoint.')
+    parser.add_argument('--model', type=str, default='G', choices=['G', 'D'], help='Generator or discriminator checkpoint.')
+    parser.add_argument('--num_spk', type=int, default=4, help='Number of speakers.')
+    parser.add_argument('--residual_depth', type=int, default=9, help='Number of residual steps in the generator bottleneck.')
+    parser.add_argument('--bottleneck_dim', type=int, default=256, help='Channels of the generator bottleneck.')
+    parser.add_argument('--residual_shared', type=str2bool, default=True, 
+        help='Allocate two residual blocks and run them as 0, 1, 0, 0, ... (original schedule); otherwise one block per step.')
+
+    argv = parser.parse_args()
+
+    if argv.model == 'G':
+        model = Generator(argv.num_spk, argv.residual_depth, argv.bottleneck_dim, argv.residual_shared)
+    else:
+        model = Discriminator(argv.num_spk)
+
+    state_dict = torch.load(argv.input, map_location=lambda storage, loc: storage)
+    model.load_state_dict(upgrade_state_dict(state_dict, model))
+    torch.save(model.state_dict(), argv.output)
+
+    count = lambda sd: sum(v.numel() for v in sd.values())
+    print(f'* Parameters: {count(state_dict)} -> {count(model.state_dict())}')
+    print(f'[SAVE]: {argv.output}')
@@ -1,17 +1,22 @@
 import argparse
 from datetime import datetime
+import functools
 import glob
+import json
 import librosa #需要pip install 安装 （https://pypi.org/project/librosa/0.7.0rc1/#files）
 # https://github.com/deezer/spleeter/issues/419
 import numpy as np
+from multiprocessing import Pool
 import os
 import shutil
 
-from utility import GenerateStatistics, speakers, cal_mcep
+from utility import F0_METHODS, FEATURE_CONFIG, FEATURES, FEATURE_DTYPES, GenerateStatistics, FeatureWriter, StageTimer, speakers, cal_mcep, file_digest, \
+    load_wav_manifest, load_feature_config, save_feature_config, shard_name
 
 #指定好参数：--dataset VCC2016
 
 FEATURE_DIM = 34
+MCEP_DIM = FEATURE_DIM + 1 # sp2mc returns the 0th to FEATURE_DIM-th coefficients.
 FRAMES = 128
 FFTSIZE = 1024
 SPEAKERS_NUM = len(speakers)
@@ -19,42 +24,61 @@ CHUNK_SIZE = 1
 EPSILON = 1e-10
 SHIFTMS = 5.0
 ALPHA = 0.42
+CACHE_VERSION = 1 # Bump when `load_wav` or `cal_mcep` change in a way the cache key does not capture.
 
-def load_wavs(dataset: str, sr):
+def list_wavs(dataset: str):
     """
-        `data`: contains all audios file path. 
-        `resdict`: contains all wav files.   
+        `data`: contains all audios file path, sorted so that chunk naming is deterministic.
+        Only the folders of `speakers` are used; any other folder is skipped.
     """
 
     data = {}
+    skipped = []
     with os.scandir(dataset) as it:
-        for entry in it:
-            if entry.is_dir():
+        for entry in sorted(it, key=lambda e: e.name):
+            if entry.is_dir() and entry.name not in speakers:
+                skipped.append(entry.name)
+            elif entry.is_dir():
                 data[entry.name] = []
                 with os.scandir(entry.path) as it_f:
                     for onefile in it_f:
                         if onefile.is_file():
                             data[entry.name].append(onefile.path)
+                data[entry.name].sort()
     print(f'* Loaded keys: {data.keys()}')
-    resdict = {}
+    if skipped:
+        print(f'[SKIP]: folders not in the speaker list: {skipped}')
 
-    cnt = 0
-    for key, value in data.items():
-        resdict[key] = {}
+    return data
 
-        for one_file in value: #预处理，突出高频信号，因为一般发音的话高频信号能表达更多有用的信息
-            filename = one_file.split('/')[-1].split('.')[0] 
-            newkey = f'{filename}'
-            wav, _ = librosa.load(one_file, sr=sr, mono=True, dtype=np.float64)#sr：采样率 mono：单通道
-            y, _ = librosa.effects.trim(wav, top_db=15)
-            wav = np.append(y[0], y[1: ] - 0.97 * y[: -1])
+def load_wav(one_file: str, sr, timer: StageTimer=None):
+    """
+        Load, trim and pre-emphasize one wav file.
+    """
+
+    timer = timer or StageTimer()
+    with timer.stage('load'):
+        wav, _ = librosa.load(one_file, sr=sr, mono=True, dtype=np.float64)#sr：采样率 mono：单通道
+    with timer.stage('trim'):
+        y, _ = librosa.effects.trim(wav, top_db=15)
+    wav = np.append(y[0], y[1: ] - 0.97 * y[: -1]) #预处理，突出高频信号，因为一般发音的话高频信号能表达更多有用的信息
+
+    return wav
 
-            resdict[key][newkey] = wav
-            print('.', end='')
+def load_wavs(dataset: str, sr):
+    """
+        Yield `(speaker, filename, wav)` one file at a time, so only a single
+        waveform is held in memory no matter how large the dataset is.
+    """
+
+    cnt = 0
+    for key, value in list_wavs(dataset).items():
+        for one_file in value:
+            filename = one_file.split('/')[-1].split('.')[0] 
+            yield key, filename, load_wav(one_file, sr)
             cnt += 1
 
     print(f'\n* Total audio files: {cnt}.')
-    return resdict
 
 def chunks(iterable, size):
     """
@@ -64,44 +88,201 @@ def chunks(iterable, size):
     for i in range(0, len(iterable), size):
         yield iterable[i: i + size]
 
-def wav_to_mcep_file(dataset: str, sr: int, processed_filepath: str='./data/processed'):
+def extract_chunk(chunk_files, sr: int, cache_dir: str=None, f0_method: str='harvest', timer: StageTimer=None):
+    """
+        Return `(f0, mcep, cached)` of one chunk of wav files.
+        Features are looked up in `cache_dir` by the content of the files and the
+        extraction parameters, so unchanged files are never analysed twice.
+    """
+
+    timer = timer or StageTimer()
+    cache_path = None
+    if cache_dir:
+        with timer.stage('cache_lookup'):
+            key = file_digest(chunk_files, CACHE_VERSION, sr, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA, f0_method)
+            cache_path = os.path.join(cache_dir, f'{key}.npz')
+            if os.path.exists(cache_path):
+                t = np.load(cache_path)
+                return t['f0'], t['mcep'], True
+
+    one_chunk = [load_wav(one_file, sr, timer) for one_file in chunk_files]
+    wav_concated = np.concatenate(one_chunk) if len(one_chunk) > 1 else one_chunk[0]
+    del one_chunk
+
+    f0, ap, mcep = cal_mcep(wav_concated, sr, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA, f0_method, timer)
+
+    if cache_path:
+        # Write then rename, so concurrent workers never see a partial file.
+        with timer.stage('cache_write'):
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, f0=f0, mcep=mcep)
+            os.replace(tmp_path, cache_path)
+
+    return f0, mcep, False
+
+def save_mcep_chunk(f0, mcep, newname: str, processed_filepath: str, dtype: str='float32'):
+    """
+        Save the features of one utterance, the MCEPs in the storage `dtype`.
+    """
+
+    file_path_z = os.path.join(processed_filepath, newname)
+    np.savez(file_path_z, f0=f0, mcep=mcep.astype(dtype))
+
+    return f'{file_path_z}.npz'
+
+def chunk_jobs(dataset: str):
+    """
+        Return `(name, wav files)` for every chunk, named `{speaker}_{index}`.
+    """
+
+    jobs = []
+    for one_speaker, files in list_wavs(dataset).items():
+        for index, one_chunk in enumerate(chunks(files, CHUNK_SIZE)):
+            jobs.append((f'{one_speaker}_{index}', one_chunk))
+
+    return jobs
+
+def _process_chunk_job(job, sr: int, processed_filepath: str, cache_dir: str=None, f0_method: str='harvest',
+    dtype: str='float32'):
+    """
+        Extract (or fetch from cache) the features of one chunk and save them.
+    """
+
+    newname, chunk_files = job
+    timer = StageTimer()
+    f0, mcep, cached = extract_chunk(chunk_files, sr, cache_dir, f0_method, timer)
+    with timer.stage('save'):
+        saved = save_mcep_chunk(f0, mcep, newname, processed_filepath, dtype)
+    timer.files += len(chunk_files)
+    timer.audio_seconds += len(f0) * SHIFTMS / 1000
+
+    return newname, saved, f0, mcep, cached, timer
+
+def wav_to_mcep_file(dataset: str, sr: int, processed_filepath: str='./data/processed', workers: int=1,
+    cache_dir: str='./data/cache', f0_method: str='harvest', timer: StageTimer=None, shard_index: int=0, num_shards: int=1,
+    dtype: str='float32'):
     """
         Convert wavs to MCEPs feature using image representation.
+        Chunks are streamed through the extraction one at a time (or by a process pool
+        with `workers` > 1). Utterances are saved as `{speaker}_{index}.npz` and their
+        MCEPs are packed in file order into a single store (see `FeatureWriter`),
+        so the result of a parallel run is identical to the serial run.
+        The store holds whole utterances, unnormalized, written exactly once; training
+        segments are cut from it by the dataset, and the speaker statistics are
+        accumulated on the way and returned.
+        Features of files already seen with the same parameters are reused from
+        `cache_dir` (pass an empty value to disable the cache).
+        The extraction parameters, including `f0_method`, are recorded in the output
+        folder so that conversion analyses test wavs the same way.
+        Per-stage times of all chunks are merged into `timer`.
+        With `num_shards` > 1 only the `shard_index`-th contiguous slice of the sorted chunk
+        list is processed and packed into its own store, see `merge_shards`.
+        MCEPs are stored as `dtype` (float32, or float16 to save space); statistics and
+        the feature cache keep full precision.
     """
 
-    shutil.rmtree(processed_filepath)
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard_index must be in [0, {num_shards}), got {shard_index}.')
+
+    timer = timer or StageTimer()
+    if num_shards > 1:
+        # Shards may share the output folder, so none of them clears it or writes the
+        # common config; `merge_shards` checks the per-shard configs and writes it.
+        store_name = shard_name(FEATURES, shard_index, num_shards)
+        config_name = f'{shard_name("feature-config", shard_index, num_shards)}.json'
+    else:
+        store_name = FEATURES
+        config_name = FEATURE_CONFIG
+        shutil.rmtree(processed_filepath, ignore_errors=True)
     os.makedirs(processed_filepath, exist_ok=True)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
 
     allwavs_cnt = len(glob.glob(f'{dataset}/*/*.wav'))
     print(f'* Total audio files: {allwavs_cnt}.')
 
-    d = load_wavs(dataset, sr)
-    for one_speaker in d.keys():
-        values_of_one_speaker = list(d[one_speaker].values())
-       
-        for index, one_chunk in enumerate(chunks(values_of_one_speaker, CHUNK_SIZE)):
-            wav_concated = [] 
-            temp = one_chunk.copy()
+    jobs = chunk_jobs(dataset)
+    jobs = jobs[len(jobs) * shard_index // num_shards: len(jobs) * (shard_index + 1) // num_shards]
+    save_feature_config(processed_filepath, config_name, sample_rate=sr, feature_dim=FEATURE_DIM, fftsize=FFTSIZE,
+        shiftms=SHIFTMS, alpha=ALPHA, f0_method=f0_method, dtype=dtype)
+    worker = functools.partial(_process_chunk_job, sr=sr, processed_filepath=processed_filepath, cache_dir=cache_dir,
+        f0_method=f0_method, dtype=dtype)
 
-            for one in temp:
-                wav_concated.extend(one)
-            wav_concated = np.array(wav_concated)
+    hits = 0
+    stats = GenerateStatistics(processed_filepath)
+    writer = FeatureWriter(processed_filepath, store_name, dtype, MCEP_DIM)
+    pool = Pool(processes=workers) if workers > 1 else None
+    try:
+        results = pool.imap(worker, jobs) if pool else map(worker, jobs)
+        for newname, saved, f0, mcep, cached, chunk_timer in results:
+            hits += cached
+            timer.merge(chunk_timer)
+            speaker = newname.rsplit('_', maxsplit=1)[0]
+            with timer.stage('statistics'):
+                stats.update(speaker, f0, mcep)
+            with timer.stage('pack'):
+                writer.append(speaker, mcep, newname)
+            print(f'[{"CACHE" if cached else "SAVE"}]: {saved}')
+    finally:
+        writer.close()
+        if pool:
+            pool.terminate()
 
-            f0, ap, mcep = cal_mcep(wav_concated, sr, FEATURE_DIM, FFTSIZE, SHIFTMS, ALPHA)
-            
-            newname = f'{one_speaker}_{index}'
-            file_path_z = os.path.join(processed_filepath, newname)
-            np.savez(file_path_z, f0=f0, mcep=mcep)
-            print(f'[SAVE]: {file_path_z}')
-
-            for start_idx in range(0, mcep.shape[1] - FRAMES + 1, FRAMES):
-                one_audio_seg = mcep[:, start_idx: start_idx + FRAMES]
-
-                if one_audio_seg.shape[1] == FRAMES:
-                    temp_name = f'{newname}_{start_idx}'
-                    filePath = os.path.join(processed_filepath, temp_name)
-                    np.save(filePath, one_audio_seg)
-                    print(f'[SAVE]: {filePath}.npy')
+    print(f'* Cache hits: {hits}/{len(jobs)}.')
+
+    return stats
+
+def merge_shards(processed_filepath: str, num_shards: int, dtype: str=None):
+    """
+        Merge the outputs of `num_shards` sharded runs, collected in `processed_filepath`,
+        into the single store of a non-sharded run and return the merged statistics.
+        All shards must have been extracted with the same parameters (and `dtype`, if given).
+    """
+
+    config_names = [f'{shard_name("feature-config", i, num_shards)}.json' for i in range(num_shards)]
+    for one_name in config_names:
+        if not os.path.exists(os.path.join(processed_filepath, one_name)):
+            raise ValueError(f'{one_name} is missing in {processed_filepath}, was every shard extracted?')
+    configs = [load_feature_config(processed_filepath, one_name) for one_name in config_names]
+    for shard_index, config in enumerate(configs):
+        if config != configs[0]:
+            raise ValueError(f'Shard {shard_index} was extracted with {config}, shard 0 with {configs[0]}.')
+    if dtype and dtype != configs[0]['dtype']:
+        raise ValueError(f'The shards are stored as {configs[0]["dtype"]}, not {dtype}.')
+    save_feature_config(processed_filepath, **configs[0])
+
+    stats = GenerateStatistics(processed_filepath)
+    writer = FeatureWriter(processed_filepath, FEATURES, configs[0]['dtype'], MCEP_DIM)
+    try:
+        for shard_index in range(num_shards):
+            stats.load_partial(os.path.join(processed_filepath, f'{shard_name("stats", shard_index, num_shards)}.npz'))
+            writer.extend(processed_filepath, shard_name(FEATURES, shard_index, num_shards))
+    finally:
+        writer.close()
+
+    return stats
+
+def rebuild_features(processed_filepath: str, dtype: str='float32'):
+    """
+        Repack the store and its manifest from the `{speaker}_{index}.npz` utterance files,
+        eg. after an interrupted run or manual changes to `processed_filepath`.
+    """
+
+    utterances = []
+    for one_file in os.listdir(processed_filepath):
+        name, ext = os.path.splitext(one_file)
+        speaker, _, index = name.rpartition('_')
+        if ext == '.npz' and speaker in speakers and index.isdigit():
+            utterances.append((speaker, int(index), name))
+
+    writer = FeatureWriter(processed_filepath, FEATURES, dtype, MCEP_DIM)
+    try:
+        for speaker, _, name in sorted(utterances):
+            t = np.load(os.path.join(processed_filepath, f'{name}.npz'))
+            writer.append(speaker, t['mcep'], name)
+    finally:
+        writer.close()
             
 if __name__ == "__main__":
     start = datetime.now()
@@ -109,7 +290,9 @@ if __name__ == "__main__":
     and calculate the speech statistical characteristics.')
     
     input_dir = './data/spk'
+    test_dir = './data/spk_test'
     output_dir = './data/processed'
+    cache_dir = './data/cache'
 
     dataset_default = 'VCC2016'
 
@@ -117,6 +300,22 @@ if __name__ == "__main__":
         help='Available datasets: VCC2016 and VCC2018 (Default: VCC2016).')
     parser.add_argument('--input_dir', type=str, default=input_dir, help='Directory of input data.')
     parser.add_argument('--output_dir', type=str, default=output_dir, help='Directory of processed data.')
+    parser.add_argument('--test_dir', type=str, default=test_dir, help='Directory of test data (wav manifest only).')
+    parser.add_argument('--cache_dir', type=str, default=cache_dir, 
+        help='Directory of cached features, an empty string disables the cache.')
+    parser.add_argument('--f0_method', type=str, default='harvest', choices=F0_METHODS,
+        help='F0 estimator: harvest (accurate) or the much faster dio / dio+stonemask (Default: harvest).')
+    parser.add_argument('--dtype', type=str, default=None, choices=FEATURE_DTYPES,
+        help='Storage type of the processed MCEPs (Default: float32; with --rebuild_manifest the recorded type).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes for feature extraction (Default: 1).')
+    parser.add_argument('--shard_index', type=int, default=0, help='Index of the shard processed by this run.')
+    parser.add_argument('--num_shards', type=int, default=1, 
+        help='Split the wav files into this many shards, eg. one per machine (Default: 1).')
+    parser.add_argument('--merge', action='store_true', 
+        help='Merge the outputs of all --num_shards shards found in --output_dir and save the statistics.')
+    parser.add_argument('--rebuild_manifest', action='store_true', 
+        help='Rebuild the feature store manifest of --output_dir and the wav manifest of --test_dir, then exit.')
+    parser.add_argument('--timing_file', type=str, default=None, help='Also write the JSON timing summary to this file.')
     
     argv = parser.parse_args()
     input_dir = argv.input_dir
@@ -134,11 +333,40 @@ if __name__ == "__main__":
     else:
         sample_rate = 22050
 
-    wav_to_mcep_file(input_dir, sample_rate, processed_filepath=output_dir)
-
-    generator = GenerateStatistics(output_dir)
-    generator.generate_stats()
-    generator.normalize_dataset()
+    timer = StageTimer()
+    dtype = argv.dtype or 'float32'
+    if argv.rebuild_manifest:
+        with timer.stage('rebuild_manifest'):
+            config = load_feature_config(output_dir)
+            if argv.dtype and argv.dtype != config['dtype']:
+                config['dtype'] = argv.dtype
+                save_feature_config(output_dir, **config)
+            rebuild_features(output_dir, config['dtype'])
+            if os.path.isdir(argv.test_dir):
+                load_wav_manifest(argv.test_dir, rebuild=True)
+    elif argv.merge:
+        with timer.stage('merge'):
+            generator = merge_shards(output_dir, argv.num_shards, argv.dtype)
+        generator.save_stats()
+    elif argv.num_shards > 1:
+        generator = wav_to_mcep_file(input_dir, sample_rate, processed_filepath=output_dir, workers=argv.workers,
+            cache_dir=argv.cache_dir, f0_method=argv.f0_method, timer=timer,
+            shard_index=argv.shard_index, num_shards=argv.num_shards, dtype=dtype)
+        generator.save_partial(os.path.join(output_dir, f'{shard_name("stats", argv.shard_index, argv.num_shards)}.npz'))
+    else:
+        generator = wav_to_mcep_file(input_dir, sample_rate, processed_filepath=output_dir, workers=argv.workers,
+            cache_dir=argv.cache_dir, f0_method=argv.f0_method, timer=timer, dtype=dtype)
+        with timer.stage('save_stats'):
+            generator.save_stats()
     end = datetime.now()
     
     print(f"* Duration: {end-start}.")
+
+    summary = timer.summary(wall_seconds=(end - start).total_seconds())
+    summary['workers'] = argv.workers
+    summary['f0_method'] = argv.f0_method
+    summary = json.dumps(summary, indent=4)
+    print(summary)
+    if argv.timing_file:
+        with open(argv.timing_file, 'w') as f:
+            f.write(summary)
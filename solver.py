@@ -12,10 +12,10 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from torchvision.utils import save_image
 
-from data_loader import TestSet
-from model import Discriminator, Generator
+from data_loader import DataPrefetcher, TestSet
+from model import Discriminator, Generator, upgrade_state_dict
 from preprocess import ALPHA, FRAMES, FFTSIZE, SHIFTMS
-from utility import Normalizer, speakers, pad_mcep, synthesis_from_mcep
+from utility import Normalizer, speakers, load_feature_config, pad_mcep, synthesis_from_mcep
 
 class Solver(object):
     def __init__(self, data_loader, config):
@@ -35,6 +35,8 @@ class Solver(object):
         # Training configurations.
         self.data_dir = config.data_dir
         self.test_dir = config.test_dir
+        # Analyse test wavs with the F0 estimator the training features were extracted with.
+        self.f0_method = load_feature_config(config.data_dir)['f0_method']
         self.batch_size = config.batch_size
         self.num_iters = config.num_iters
         self.num_iters_decay = config.num_iters_decay
@@ -44,15 +46,19 @@ class Solver(object):
         self.beta1 = config.beta1
         self.beta2 = config.beta2
         self.resume_iters = config.resume_iters
+        self.prefetch = config.prefetch
         
         # Test configurations.
         self.test_iters = config.test_iters
         self.trg_speaker = ast.literal_eval(config.trg_speaker)
         self.src_speaker = config.src_speaker
+        self.test_cache_dir = config.test_cache_dir
+        self.test_set = None
 
         self.use_tensorboard = config.use_tensorboard
         self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.spk_enc = LabelBinarizer().fit(speakers)
+        self.label_table = torch.FloatTensor(self.spk_enc.transform(speakers)).to(self.device)
 
         self.log_dir = config.log_dir
         self.sample_dir = config.sample_dir
@@ -70,7 +76,8 @@ class Solver(object):
             self.build_tensorboard()
     
     def build_model(self):
-        self.G = Generator(num_speakers=self.num_spk)
+        self.G = Generator(num_speakers=self.num_spk, residual_depth=self.config.residual_depth,
+            bottleneck_dim=self.config.bottleneck_dim, residual_shared=self.config.residual_shared)
         self.D = Discriminator(num_speakers=self.num_spk)
 
         self.g_optimizer = torch.optim.Adam(self.G.parameters(), self.g_lr, [self.beta1, self.beta2])
@@ -103,6 +110,26 @@ class Solver(object):
         for param_group in self.d_optimizer.param_groups:
             param_group['lr'] = d_lr
 
+    def batches(self):
+        """
+            Endless stream of training batches on `self.device`, moved there
+            by a background prefetcher unless `--prefetch 0`.
+        """
+
+        if self.prefetch > 0:
+            return DataPrefetcher(self.data_loader, self.device, self.prefetch)
+        return ([x.to(self.device) for x in batch] for batch in self.data_loader)
+
+    def test_data(self, src_speaker=None):
+        """
+            Test features of `src_speaker` (random if None) from one TestSet shared by all
+            sample steps, so every speaker is analysed at most once per run.
+        """
+
+        if self.test_set is None:
+            self.test_set = TestSet(self.test_dir, self.sample_rate, self.f0_method, self.test_cache_dir)
+        return self.test_set.test_data(src_speaker)
+
     def train(self):
         # Learning rate cache for decaying.
         g_lr = self.g_lr
@@ -115,7 +142,8 @@ class Solver(object):
             self.restore_model(self.resume_iters)   
 
         norm = Normalizer()
-        data_iter = iter(self.data_loader)
+        data_iter = self.batches()
+        data_wait = 0.0  # Seconds spent waiting for batches since the last log.
 
         g_adv_optim = 0            
         g_adv_converge_low = True  # Check which direction `g_adv` is converging (init as low).
@@ -128,22 +156,14 @@ class Solver(object):
         start_time = datetime.now()
 
         for i in range(start_iters, self.num_iters):
-            try:
-                x_real, speaker_idx_org, label_org = next(data_iter)
-                #print (x_real.shape,speaker_idx_org.shape,label_org.shape)
-            except:
-                data_iter = iter(self.data_loader)
-                x_real, speaker_idx_org, label_org = next(data_iter)    
-
-            rand_idx = torch.randperm(label_org.size(0))
-            label_trg = label_org[rand_idx]
-            speaker_idx_trg = speaker_idx_org[rand_idx]
-            
-            x_real = x_real.to(self.device)           
-            label_org = label_org.to(self.device)             # Original domain one-hot labels.
-            label_trg = label_trg.to(self.device)             # Target domain one-hot labels.
-            speaker_idx_org = speaker_idx_org.to(self.device) # Original domain labels.
-            speaker_idx_trg = speaker_idx_trg.to(self.device) # Target domain labels.
+            wait_start = time.perf_counter()
+            # The loader never runs out, so any exception here is a real loading error.
+            x_real, speaker_idx_org, label_org = next(data_iter)
+            data_wait += time.perf_counter() - wait_start
+
+            # Batches arrive on self.device; shift every source by 1..n-1 speakers, so that the target always differs.
+            speaker_idx_trg = (speaker_idx_org + torch.randint(1, len(speakers), speaker_idx_org.size(), device=self.device)) % len(speakers)
+            label_trg = self.label_table[speaker_idx_trg]    # Target domain one-hot labels.
 
             """
                 Discriminator training.
@@ -182,8 +202,10 @@ class Solver(object):
                 Generator training.
             """        
             if (i + 1) % self.n_critic == 0:
+                # Encode x_real once for the target and the identity mapping.
+                x_fake, x_fake_id = self.G.forward_targets(x_real, label_org, [label_trg, label_org])
+
                 # Loss: st-adv (original-to-target).
-                x_fake = self.G(x_real, label_org, label_trg)
                 g_out_src = self.D(x_fake, label_org, label_trg)
                 g_loss_adv = F.binary_cross_entropy_with_logits(input=g_out_src, target=torch.ones_like(g_out_src, dtype=torch.float))
                 
@@ -192,7 +214,6 @@ class Solver(object):
                 g_loss_rec = F.l1_loss(x_rec, x_real)
 
                 # Loss: id (original-to-original).
-                x_fake_id = self.G(x_real, label_org, label_org)
                 g_loss_id = F.l1_loss(x_fake_id, x_real)
 
                 # Total loss: st-adv + lambda_cyc * cyc (+ lambda_id * id).
@@ -274,16 +295,19 @@ class Solver(object):
                 log = "Elapsed [{}], Iteration [{}/{}]".format(et, i + 1, self.num_iters)
                 for tag, value in loss.items():
                     log += ", {}: {:.4f}".format(tag, value)
+                log += ", data wait: {:.2f}s".format(data_wait)
                 print(log)
 
                 if self.use_tensorboard:
                     for tag, value in loss.items():
                         self.logger.scalar_summary(tag, value, i + 1)
+                    self.logger.scalar_summary('Data/wait_seconds', data_wait, i + 1)
+                data_wait = 0.0
 
             # Translate fixed images for debugging.
             if (i + 1) % self.sample_step == 0:
                 with torch.no_grad():
-                    d, speaker = TestSet(self.test_dir, self.sample_rate).test_data()
+                    d, speaker = self.test_data()
                     original = random.choice([x for x in speakers if x != speaker])
                     target = random.choice([x for x in speakers if x != speaker])
                     label_o = self.spk_enc.transform([original])[0]
@@ -371,8 +395,9 @@ class Solver(object):
         print(f'Loading the trained models from step {resume_iters}...')
         G_path = os.path.join(self.model_save_dir, '{}-G.ckpt'.format(resume_iters))
         D_path = os.path.join(self.model_save_dir, '{}-D.ckpt'.format(resume_iters))
-        self.G.load_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage))
-        self.D.load_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage))
+        # Checkpoints from before the gated convolutions were fused are converted on load.
+        self.G.load_state_dict(upgrade_state_dict(torch.load(G_path, map_location=lambda storage, loc: storage), self.G))
+        self.D.load_state_dict(upgrade_state_dict(torch.load(D_path, map_location=lambda storage, loc: storage), self.D))
 
     def convert(self):
         """
@@ -382,40 +407,37 @@ class Solver(object):
         self.restore_model(self.test_iters)
         norm = Normalizer()
 
-        d, speaker = TestSet(self.test_dir, self.sample_rate).test_data(self.src_speaker)#相同的特征提取和读取方式
+        d, speaker = self.test_data(self.src_speaker)#相同的特征提取和读取方式
         targets = self.trg_speaker
-       
         for target in targets:
-            print(f'* Target: {target}')
             assert target in speakers
-            label_o = self.spk_enc.transform([self.src_speaker])[0]
-            label_t = self.spk_enc.transform([target])[0]
-            label_o = np.asarray([label_o])
-            label_t = np.asarray([label_t])
-            
-            with torch.no_grad():
-                for filename, content in d.items():
-                    f0 = content['f0']
-                    ap = content['ap']
-                    mcep_norm_pad = pad_mcep(content['mcep_norm'], FRAMES)
-
-                    convert_result = []
-                    for start_idx in range(0, mcep_norm_pad.shape[1] - FRAMES + 1, FRAMES):
-                        one_seg = mcep_norm_pad[:, start_idx: start_idx + FRAMES]
-                        
-                        one_seg = torch.FloatTensor(one_seg).to(self.device)
-                        one_seg = one_seg.view(1, 1, one_seg.size(0), one_seg.size(1))
-                        o = torch.FloatTensor(label_o)
-                        t = torch.FloatTensor(label_t)
-                        one_seg = one_seg.to(self.device)
-                        o = o.to(self.device)
-                        t = t.to(self.device)
-                        one_set_return = self.G(one_seg, o, t).data.cpu().numpy()
-                        one_set_return = np.squeeze(one_set_return)
+        print(f'* Targets: {targets}')
+
+        # Speaker indices into the AdaIN tables, computed once for the loaded weights.
+        self.G.build_style_tables()
+        src_idx = int(self.spk_enc.transform([self.src_speaker]).argmax())
+        trg_idx = self.spk_enc.transform(targets).argmax(axis=1).tolist()
+       
+        with torch.no_grad():
+            for filename, content in d.items():
+                f0 = content['f0']
+                ap = content['ap']
+                mcep_norm_pad = pad_mcep(content['mcep_norm'], FRAMES)
+
+                # Every segment is encoded once and decoded for all targets together.
+                convert_result = {target: [] for target in targets}
+                for start_idx in range(0, mcep_norm_pad.shape[1] - FRAMES + 1, FRAMES):
+                    one_seg = mcep_norm_pad[:, start_idx: start_idx + FRAMES]
+                    
+                    one_seg = torch.FloatTensor(one_seg).to(self.device)
+                    one_seg = one_seg.view(1, 1, one_seg.size(0), one_seg.size(1))
+                    for target, one_set_return in zip(targets, self.G.forward_indices(one_seg, src_idx, trg_idx)):
+                        one_set_return = np.squeeze(one_set_return.data.cpu().numpy())
                         one_set_return = norm.backward_process(one_set_return, target)
-                        convert_result.append(one_set_return)
+                        convert_result[target].append(one_set_return)
 
-                    convert_con = np.concatenate(convert_result, axis=1)
+                for target in targets:
+                    convert_con = np.concatenate(convert_result[target], axis=1)
                     convert_con = convert_con[:, 0: content['mcep_norm'].shape[1]]
                     contigu = np.ascontiguousarray(convert_con.T, dtype=np.float64)
                     f0_converted = norm.pitch_conversion(f0, speaker, target)
@@ -424,4 +446,4 @@ class Solver(object):
                     name = f'{speaker}-{target}_iter{self.test_iters}_{filename}'
                     path = os.path.join(self.result_dir, name)
                     print(f'[SAVE]: {path}')
-                    librosa.output.write_wav(path, wav, self.sample_rate)            
+                    librosa.output.write_wav(path, wav, self.sample_rate)
@@ -1,10 +1,14 @@
+from contextlib import contextmanager
 import glob
+import hashlib
+import json
 import librosa
 import numpy as np
 import os
 import pysptk #pip install 如安装出现问题，可以使用vs命令行来安装
 import pyworld as pw
 import shutil
+import time
 
 class Singleton(type):
     def __init__(self, *args, **kwargs):
@@ -101,59 +105,132 @@ class Normalizer(object):
 
         return f0_converted
     
+class RunningStatistics(object):
+    """
+        Streaming mean/std over the first axis of the updates.
+        Uses Welford's update and Chan's pairwise merge, so memory is O(feature dim)
+        and partial results (eg. from parallel workers) can be combined exactly.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if x.shape[0] == 0:
+            return
+        mean = np.mean(x, axis=0)
+        self._combine(x.shape[0], mean, np.sum((x - mean) ** 2, axis=0))
+
+    def merge(self, other):
+        if other.count > 0:
+            self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
 class GenerateStatistics(object):
     def __init__(self, folder: str ='./data/processed'):
         self.folder = folder
         self.include_dict_npz = {}
+        self.mcep_stats = {}
+        self.log_f0_stats = {}
 
         for s in speakers:
             if not self.include_dict_npz.__contains__(s):
                 self.include_dict_npz[s] = []
+            self.mcep_stats[s] = RunningStatistics()
+            self.log_f0_stats[s] = RunningStatistics()
 
             for one_file in os.listdir(folder):
                 if one_file.startswith(s) and one_file.endswith('npz'):
                     self.include_dict_npz[s].append(one_file)
-        
-    @staticmethod
-    def mcep_statistics(coded_sps):
-        mcep_concatenated = np.concatenate(coded_sps, axis=1)
-        mcep_mean = np.mean(mcep_concatenated, axis=1, keepdims=False)
-        mcep_std = np.std(mcep_concatenated, axis=1, keepdims=False)
-        return mcep_mean, mcep_std
 
-    @staticmethod
-    def logf0_statistics(f0s):
-        log_f0s_concatenated = np.ma.log(np.concatenate(f0s))
-        log_f0s_mean = log_f0s_concatenated.mean()
-        log_f0s_std = log_f0s_concatenated.std()
+    def update(self, speaker, f0, mcep):
+        """
+            Accumulate one utterance; unvoiced frames (f0 == 0) are left out of the f0 statistics.
+        """
+
+        self.mcep_stats[speaker].update(mcep.T)
+        self.log_f0_stats[speaker].update(np.log(f0[f0 > 0]))
+
+    def merge(self, other):
+        """
+            Merge the partial statistics accumulated by another instance.
+        """
+
+        for one_speaker in speakers:
+            self.mcep_stats[one_speaker].merge(other.mcep_stats[one_speaker])
+            self.log_f0_stats[one_speaker].merge(other.log_f0_stats[one_speaker])
+
+    def save_partial(self, filename: str):
+        """
+            Save the running moments, to be merged later by `load_partial`.
+        """
+
+        d = {}
+        for one_speaker in speakers:
+            for kind, acc in (('mcep', self.mcep_stats[one_speaker]), ('log_f0', self.log_f0_stats[one_speaker])):
+                d[f'{one_speaker}/{kind}_count'] = acc.count
+                d[f'{one_speaker}/{kind}_mean'] = acc.mean
+                d[f'{one_speaker}/{kind}_m2'] = acc.m2
+        np.savez(filename, **d)
+        print(f'[SAVE]: {filename}')
+
+    def load_partial(self, filename: str):
+        """
+            Merge running moments saved by `save_partial`.
+        """
 
-        return log_f0s_mean, log_f0s_std
+        t = np.load(filename)
+        for one_speaker in speakers:
+            for kind, acc in (('mcep', self.mcep_stats[one_speaker]), ('log_f0', self.log_f0_stats[one_speaker])):
+                other = RunningStatistics()
+                other.count = int(t[f'{one_speaker}/{kind}_count'])
+                other.mean = t[f'{one_speaker}/{kind}_mean']
+                other.m2 = t[f'{one_speaker}/{kind}_m2']
+                acc.merge(other)
 
     def generate_stats(self, statfolder: str = 'etc'):
         """
             Generate all user's statistics used for calutate normalized.
-            Step 1: generate mcep mean std.
-            Step 2: generate f0 mean std.
+            Every utterance file is visited once and only the running moments are kept.
+        """
+
+        for one_speaker in self.include_dict_npz.keys():
+            for one_file in self.include_dict_npz[one_speaker]:
+                t = np.load(os.path.join(self.folder, one_file))
+                self.update(one_speaker, t['f0'], t['mcep'])
+
+        self.save_stats(statfolder)
+
+    def save_stats(self, statfolder: str = 'etc'):
+        """
+            Step 1: save mcep mean std.
+            Step 2: save f0 mean std.
         """
 
         etc_path = os.path.join(os.path.realpath('.'), statfolder)
         os.makedirs(etc_path, exist_ok=True)
 
-        for one_speaker in self.include_dict_npz.keys():
-            f0s = []
-            mceps = []           
-            arr01 = self.include_dict_npz[one_speaker]
-            if len(arr01) == 0:
+        for one_speaker in speakers:
+            mcep_stats = self.mcep_stats[one_speaker]
+            log_f0_stats = self.log_f0_stats[one_speaker]
+            if mcep_stats.count == 0:
                 continue
-            for one_file in arr01:
-                t = np.load(os.path.join(self.folder, one_file))
-                f0_ = np.reshape(t['f0'], [-1, 1])
 
-                f0s.append(f0_)
-                mceps.append(t['mcep'])
-            
-            log_f0s_mean, log_f0s_std = self.logf0_statistics(f0s)
-            mcep_mean, mcep_std = self.mcep_statistics(mceps)
+            log_f0s_mean, log_f0s_std = log_f0_stats.mean, log_f0_stats.std
+            mcep_mean, mcep_std = mcep_stats.mean, mcep_stats.std
 
             print(f'log_f0s_mean: {log_f0s_mean}, log_f0s_std: {log_f0s_std}')
             print(f'mcep_mean: {mcep_mean.shape}, mcep_std: {mcep_std.shape}')
@@ -164,34 +241,294 @@ class GenerateStatistics(object):
                 mcep_mean=mcep_mean, mcep_std=mcep_std)
 
             print(f'[SAVE]: {filename}')
-  
-    def normalize_dataset(self):
-        norm  = Normalizer()
-        files = librosa.util.find_files(self.folder, ext='npy')
-
-        for p in files:
-            filename = os.path.basename(p)
-            speaker = filename.split(sep='_', maxsplit=1)[0]
-            mcep = np.load(p)
-            mcep_normed = norm.forward_process(mcep, speaker)
-            os.remove(p)
-            np.save(p, mcep_normed)
-            print(f'[NORM]: {p}')
-
-def world_features(wav, sr, fft_size, dim, shiftms):
-    f0, timeaxis = pw.harvest(wav, sr, frame_period=shiftms) #语音基频特征 声音一般可以分解为许多单纯的正弦波，所有的自然声音基本都是由许多频率不同的正弦波组成的，其中频率最低的正弦波即为基音
-    sp = pw.cheaptrick(wav, f0, timeaxis, sr, fft_size=fft_size) # 频谱包络
-    ap = pw.d4c(wav, f0, timeaxis, sr, fft_size=fft_size) # aperiodic参数
+
+FEATURES = 'features'
+FEATURE_DTYPES = ['float32', 'float16']
+
+def shard_name(name: str, shard_index: int, num_shards: int):
+    """
+        Return the file name stem of one shard, eg. `features-00001-of-00004`.
+    """
+
+    return f'{name}-{shard_index:05d}-of-{num_shards:05d}'
+
+class FeatureWriter(object):
+    """
+        FeatureWriter: pack the MCEPs of whole utterances into one contiguous float32 file.
+        Utterances are stored frame-major, (frames, feature_dim), one after another in
+        `{name}.bin`; `{name}-index.npz` is the manifest of the store, it records the name,
+        speaker, frame offset, byte offset and frame count of each one.
+        `dtype` float16 halves the size again for archiving, loaders always return float32.
+        `feature_dim` is taken from the first utterance unless given; give it so that an
+        empty store (eg. a shard without files) still records it.
+    """
+
+    def __init__(self, folder: str, name: str=FEATURES, dtype: str='float32', feature_dim: int=None):
+        assert dtype in FEATURE_DTYPES
+        self.folder = folder
+        self.name = name
+        self.dtype = dtype
+        self.feature_dim = feature_dim
+        self.names = []
+        self.speaker_idx = []
+        self.offsets = []
+        self.frames = []
+        self.total_frames = 0
+        self.f = open(os.path.join(folder, f'{name}.bin'), 'wb')
+
+    def append(self, speaker, mcep, name: str=''):
+        """
+            Append one utterance of shape (feature_dim, frames), `name` identifies it in the index.
+        """
+
+        if self.feature_dim is None:
+            self.feature_dim = mcep.shape[0]
+        assert mcep.shape[0] == self.feature_dim
+
+        np.ascontiguousarray(mcep.T, dtype=self.dtype).tofile(self.f)
+        self.names.append(name)
+        self.speaker_idx.append(speakers.index(speaker))
+        self.offsets.append(self.total_frames)
+        self.frames.append(mcep.shape[1])
+        self.total_frames += mcep.shape[1]
+
+    def extend(self, folder: str, name: str):
+        """
+            Append every utterance of another packed store, copying its bytes as they are.
+        """
+
+        t = np.load(os.path.join(folder, f'{name}-index.npz'))
+        if self.feature_dim is None:
+            self.feature_dim = int(t['feature_dim'])
+        assert int(t['feature_dim']) == self.feature_dim
+        assert str(t['dtype']) == self.dtype
+
+        with open(os.path.join(folder, f'{name}.bin'), 'rb') as f:
+            shutil.copyfileobj(f, self.f, 1 << 24)
+        self.names.extend(t['names'].tolist())
+        self.speaker_idx.extend(t['speaker_idx'].tolist())
+        self.offsets.extend((t['offsets'] + self.total_frames).tolist())
+        self.frames.extend(t['frames'].tolist())
+        self.total_frames += int(np.sum(t['frames']))
+
+    def close(self):
+        self.f.close()
+        filename = os.path.join(self.folder, f'{self.name}-index.npz')
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        np.savez(filename,
+            names=np.asarray(self.names, dtype=str),
+            speaker_idx=np.asarray(self.speaker_idx, dtype=np.int64),
+            offsets=offsets,
+            byte_offsets=offsets * (self.feature_dim or 0) * np.dtype(self.dtype).itemsize,
+            frames=np.asarray(self.frames, dtype=np.int64),
+            feature_dim=self.feature_dim,
+            dtype=self.dtype)
+        print(f'[SAVE]: {filename} ({len(self.offsets)} utterances, {self.total_frames} frames)')
+
+def load_features(folder: str, mode: str='r', name: str=FEATURES):
+    """
+        Return the utterance index as a dict and the packed store as a
+        (total_frames, feature_dim) memmap of the stored dtype; an utterance is
+        `store[offset: offset + frames]`.
+    """
+
+    t = np.load(os.path.join(folder, f'{name}-index.npz'))
+    index = {k: t[k] for k in t.files}
+    index.setdefault('dtype', np.array('float32'))
+
+    data_path = os.path.join(folder, f'{name}.bin')
+    expected = int(np.sum(index['frames'])) * int(index['feature_dim']) * np.dtype(str(index['dtype'])).itemsize
+    if os.path.getsize(data_path) != expected:
+        raise ValueError(f'{data_path} does not match its index, rebuild it with '
+            f'`python preprocess.py --rebuild_manifest --output_dir {folder}`.')
+    store = np.memmap(data_path, dtype=str(index['dtype']), mode=mode)
+    store = store.reshape(-1, int(index['feature_dim']))
+
+    return index, store
+
+WAV_MANIFEST = 'manifest.json'
+
+def build_wav_manifest(folder: str):
+    """
+        Scan `folder/{speaker}/**.wav` once and save the sorted file lists, together
+        with the modification time of every folder below the speaker folders, to
+        `folder/manifest.json`.
+    """
+
+    manifest = {'mtimes': {}, 'files': {}}
+    with os.scandir(folder) as it:
+        for entry in sorted(it, key=lambda e: e.name):
+            if entry.is_dir():
+                files = []
+                for root, _, names in os.walk(entry.path):
+                    # A folder's mtime changes when files are added to or removed from it.
+                    manifest['mtimes'][os.path.relpath(root, folder)] = os.stat(root).st_mtime
+                    files.extend(os.path.relpath(os.path.join(root, n), folder) for n in names if n.lower().endswith('.wav'))
+                manifest['files'][entry.name] = sorted(files)
+
+    filename = os.path.join(folder, WAV_MANIFEST)
+    try:
+        with open(filename, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        print(f'[SAVE]: {filename}')
+    except OSError:
+        print(f'[SKIP]: {filename} is not writable, the manifest is rebuilt on every start.')
+
+    return manifest
+
+def load_wav_manifest(folder: str, rebuild: bool=False):
+    """
+        Return `{speaker: [wav paths]}` of `folder` from its manifest.
+        The manifest is rebuilt when it is missing, the set of speaker folders changed or
+        any folder below them changed since it was written, which costs one stat per
+        folder rather than a recursive scan of the files.
+    """
+
+    filename = os.path.join(folder, WAV_MANIFEST)
+    manifest = None
+    if not rebuild and os.path.exists(filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+        with os.scandir(folder) as it:
+            speaker_dirs = sorted(e.name for e in it if e.is_dir())
+        if speaker_dirs != sorted(manifest['files']):
+            manifest = None
+        else:
+            for one_dir, mtime in manifest['mtimes'].items():
+                p = os.path.join(folder, one_dir)
+                if not os.path.isdir(p) or os.stat(p).st_mtime != mtime:
+                    manifest = None
+                    break
+    if manifest is None:
+        manifest = build_wav_manifest(folder)
+
+    return {k: [os.path.join(folder, p) for p in v] for k, v in manifest['files'].items()}
+
+def file_digest(paths, *params):
+    """
+        Return a sha1 hex digest of the content of `paths` and the given parameters.
+    """
+
+    h = hashlib.sha1()
+    for p in paths:
+        with open(p, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(repr(params).encode())
+
+    return h.hexdigest()
+
+FEATURE_CONFIG = 'feature-config.json'
+F0_METHODS = ['harvest', 'dio', 'dio+stonemask']
+
+def save_feature_config(folder: str, filename: str=FEATURE_CONFIG, **config):
+    """
+        Record the extraction parameters next to the features they produced.
+    """
+
+    filename = os.path.join(folder, filename)
+    with open(filename, 'w') as f:
+        json.dump(config, f, indent=4, sort_keys=True)
+    print(f'[SAVE]: {filename}')
+
+def load_feature_config(folder: str, filename: str=FEATURE_CONFIG):
+    """
+        Return the recorded extraction parameters, with the defaults of
+        features extracted before they were recorded.
+    """
+
+    config = {'f0_method': 'harvest', 'dtype': 'float32'}
+    filename = os.path.join(folder, filename)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            config.update(json.load(f))
+
+    return config
+
+class StageTimer(object):
+    """
+        StageTimer: accumulate wall time per named stage and the audio duration processed.
+        Timers of parallel workers can be merged, their stage times then add up to more
+        than the wall time of the whole run.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.audio_seconds = 0.0
+        self.files = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def merge(self, other):
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + other.calls[name]
+        self.audio_seconds += other.audio_seconds
+        self.files += other.files
+
+    def summary(self, wall_seconds: float=None):
+        """
+            Return a JSON-serializable dict; real-time factor is processing seconds per audio second.
+        """
+
+        rtf = lambda seconds: seconds / self.audio_seconds if self.audio_seconds else None
+        res = {
+            'files': self.files,
+            'audio_seconds': self.audio_seconds,
+            'stages': {name: {
+                'seconds': seconds,
+                'calls': self.calls[name],
+                'real_time_factor': rtf(seconds),
+            } for name, seconds in sorted(self.seconds.items(), key=lambda kv: -kv[1])},
+        }
+        if wall_seconds is not None:
+            res['wall_seconds'] = wall_seconds
+            res['real_time_factor'] = rtf(wall_seconds)
+            res['files_per_second'] = self.files / wall_seconds if wall_seconds > 0 else None
+
+        return res
+
+def world_features(wav, sr, fft_size, dim, shiftms, f0_method='harvest', timer: StageTimer=None):
+    """
+        `f0_method`: `harvest` (accurate, slow), `dio` (fast) or `dio+stonemask` (fast, refined).
+    """
+
+    timer = timer or StageTimer()
+    if f0_method == 'harvest':
+        with timer.stage('harvest'):
+            f0, timeaxis = pw.harvest(wav, sr, frame_period=shiftms) #语音基频特征 声音一般可以分解为许多单纯的正弦波，所有的自然声音基本都是由许多频率不同的正弦波组成的，其中频率最低的正弦波即为基音
+    elif f0_method in ('dio', 'dio+stonemask'):
+        with timer.stage('dio'):
+            f0, timeaxis = pw.dio(wav, sr, frame_period=shiftms)
+        if f0_method == 'dio+stonemask':
+            with timer.stage('stonemask'):
+                f0 = pw.stonemask(wav, f0, timeaxis, sr)
+    else:
+        raise ValueError(f'Unknown f0 method: {f0_method}, available: {F0_METHODS}.')
+    with timer.stage('cheaptrick'):
+        sp = pw.cheaptrick(wav, f0, timeaxis, sr, fft_size=fft_size) # 频谱包络
+    with timer.stage('d4c'):
+        ap = pw.d4c(wav, f0, timeaxis, sr, fft_size=fft_size) # aperiodic参数
 
     return f0, timeaxis, sp, ap
 
-def cal_mcep(wav, sr, dim, fft_size, shiftms, alpha):
+def cal_mcep(wav, sr, dim, fft_size, shiftms, alpha, f0_method='harvest', timer: StageTimer=None):
     """
         Calculate MCEPs given wav singnal.
     """
 
-    f0, timeaxis, sp, ap = world_features(wav, sr, fft_size, dim, shiftms)
-    mcep = mcep_from_spec(sp, dim, alpha) #MFCC：连续语音--预加重--加窗分帧--FFT--MEL滤波器组--对数运算--DCT
+    timer = timer or StageTimer()
+    f0, timeaxis, sp, ap = world_features(wav, sr, fft_size, dim, shiftms, f0_method, timer)
+    with timer.stage('sp2mc'):
+        mcep = mcep_from_spec(sp, dim, alpha) #MFCC：连续语音--预加重--加窗分帧--FFT--MEL滤波器组--对数运算--DCT
     mcep = mcep.T
 
     return f0, ap, mcep